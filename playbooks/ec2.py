@@ -113,12 +113,17 @@ from __future__ import print_function
 import sys
 import os
 import argparse
+import random
 import re
-from time import time
+import shutil
+import sqlite3
+import threading
+from collections import defaultdict
+from itertools import chain
+from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor
 import boto
 from boto import ec2
-from boto import rds
-from boto import route53
 import six.moves.configparser
 import traceback
 import six
@@ -129,6 +134,52 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Upper bound on the number of concurrent AWS API requests made while
+# refreshing the cache
+MAX_WORKERS = 16
+
+# Buffer size used when reading and writing the cache files
+CACHE_BUFFER_SIZE = 1 << 20
+
+# Number of instances requested per DescribeInstances call, this is the
+# largest page size EC2 allows
+EC2_PAGE_SIZE = 1000
+
+# Number of instances requested per DescribeDBInstances call, this is the
+# largest page size RDS allows
+RDS_PAGE_SIZE = 100
+
+# Characters that cannot be used in Ansible group names, see to_safe
+UNSAFE_CHARS_RE = re.compile(r"[^A-Za-z0-9\-]")
+
+# Prefixes of the inventory group names
+TYPE_PREFIX = 'type_'
+KEY_PREFIX = 'key_'
+SECURITY_GROUP_PREFIX = 'security_group_'
+TAG_PREFIX = 'tag_'
+FIRST_IN_PREFIX = 'first_in_'
+RDS_PREFIX = 'rds_'
+RDS_PARAMETER_GROUP_PREFIX = 'rds_parameter_group_'
+
+# Instance attributes that Route53 records are matched against
+ROUTE53_INSTANCE_ATTRIBUTES = ('public_dns_name', 'private_dns_name',
+                               'ip_address', 'private_ip_address')
+
+
+def is_throttled(error):
+    ''' Whether a BotoServerError means AWS is throttling us or is briefly
+    unavailable, in which case the request is worth retrying later '''
+
+    error_code = error.error_code or ''
+    return (error.status == 503 or 'Throttl' in error_code or
+            error_code == 'RequestLimitExceeded')
+
 
 class Ec2Inventory(object):
     def __init__(self):
@@ -136,11 +187,21 @@ class Ec2Inventory(object):
 
         # Inventory grouped by instance IDs, tags, security groups, regions,
         # and availability zones
-        self.inventory = {}
+        self.inventory = defaultdict(list)
 
         # Index of hostname (address) to instance ID
         self.index = {}
 
+        # Group names already built from a prefix and a name, see
+        # get_group_name
+        self.group_names = {}
+
+        # Group names already built from a tag, see get_tag_group_names
+        self.tag_group_names = {}
+
+        # boto connections by service and region, see get_connection
+        self.connections = {}
+
         # Read settings and parse CLI arguments
         self.parse_cli_args()
         self.read_settings()
@@ -151,17 +212,22 @@ class Ec2Inventory(object):
         elif not self.is_cache_valid():
             self.do_api_calls_update_cache()
 
-        # Data to print
+        # Data to print, it is already encoded so it is written out as is
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
         if self.args.host:
             data_to_print = self.get_host_info()
 
         elif self.args.list:
             # Display list of instances for inventory
             if len(self.inventory) == 0:
-                data_to_print = self.get_inventory_from_cache()
+                self.copy_inventory_from_cache(stdout)
+                data_to_print = b''
+            elif self.args.tags_only:
+                data_to_print = self.json_format_dict(self.get_tag_groups(), True)
             else:
                 data_to_print = self.json_format_dict(self.inventory, True)
-        print(data_to_print)
+
+        stdout.write(data_to_print + b'\n')
 
 
     def is_cache_valid(self):
@@ -172,14 +238,17 @@ class Ec2Inventory(object):
         else:
             to_check = self.cache_path_cache
 
-        if os.path.isfile(to_check):
-            mod_time = os.path.getmtime(to_check)
-            current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
-                if os.path.isfile(self.cache_path_index):
-                    return True
+        # One stat per file; a file that is missing, or that disappears
+        # while we look at it, makes the cache invalid
+        try:
+            mod_time = os.stat(to_check).st_mtime
+            if (mod_time + self.cache_max_age) <= time():
+                return False
+            os.stat(self.cache_path_index)
+        except OSError:
+            return False
 
-        return False
+        return True
 
 
     def read_settings(self):
@@ -196,8 +265,10 @@ class Ec2Inventory(object):
         if self.eucalyptus and config.has_option('ec2', 'eucalyptus_host'):
             self.eucalyptus_host = config.get('ec2', 'eucalyptus_host')
 
-        # Regions
+        # Regions, and their RegionInfo when they were listed from EC2 so
+        # that get_ec2_connection does not need to look them up again
         self.regions = []
+        self.region_infos = {}
         configRegions = config.get('ec2', 'regions')
         configRegions_exclude = config.get('ec2', 'regions_exclude')
         if (configRegions == 'all'):
@@ -207,6 +278,7 @@ class Ec2Inventory(object):
                 for regionInfo in ec2.regions():
                     if regionInfo.name not in configRegions_exclude:
                         self.regions.append(regionInfo.name)
+                        self.region_infos[regionInfo.name] = regionInfo
         else:
             self.regions = configRegions.split(",")
 
@@ -238,7 +310,7 @@ class Ec2Inventory(object):
 
         self.cache_path_cache = cache_path + "/{}ansible-ec2.cache".format(aws_profile)
         self.cache_path_tags = cache_path + "/{}ansible-ec2.tags.cache".format(aws_profile)
-        self.cache_path_index = cache_path + "/{}ansible-ec2.index".format(aws_profile)
+        self.cache_path_index = cache_path + "/{}ansible-ec2.index.db".format(aws_profile)
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
 
     def parse_cli_args(self):
@@ -270,86 +342,149 @@ class Ec2Inventory(object):
         if self.route53_enabled:
             self.get_route53_records()
 
-        for region in self.regions:
-            self.get_instances_by_region(region)
-            self.get_rds_instances_by_region(region)
+        # Fetch every region concurrently, but add the results to the
+        # inventory from this thread and in region order so that the
+        # first_in_* groups stay deterministic
+        max_workers = max(1, min(MAX_WORKERS, 2 * len(self.regions)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetches = [(region,
+                        executor.submit(self.get_instances_by_region, region),
+                        executor.submit(self.get_rds_instances_by_region, region))
+                       for region in self.regions]
+
+            for region, ec2_fetch, rds_fetch in fetches:
+                for instance in ec2_fetch.result():
+                    self.add_instance(instance, region)
+                for instance in rds_fetch.result():
+                    self.add_rds_instance(instance, region)
 
-        if self.args.tags_only:
-            self.write_to_cache(self.inventory, self.cache_path_tags)
-        else:
-            self.write_to_cache(self.inventory, self.cache_path_cache)
+        self.write_to_cache(self.inventory, self.cache_path_cache)
+        self.write_to_cache(self.get_tag_groups(), self.cache_path_tags)
 
-        self.write_to_cache(self.index, self.cache_path_index)
+        self.write_index_to_cache()
 
     def get_instances_by_region(self, region):
         ''' Makes an AWS EC2 API call to the list of instances in a particular
-        region '''
+        region, and returns them. Runs in a worker thread, so it must not
+        touch the inventory or the index. '''
 
         try:
+            conn = self.get_ec2_connection(region)
+
+            # Only want running instances; let EC2 do the filtering. The
+            # results are fetched a page at a time, which keeps each response
+            # small, but the instances of every page are still collected and
+            # returned together. The eucalyptus API version does not support
+            # pagination, so it gets everything at once.
             if self.eucalyptus:
-                conn = boto.connect_euca(host=self.eucalyptus_host)
-                conn.APIVersion = '2010-08-31'
+                max_results = None
             else:
-                conn = ec2.connect_to_region(region)
-
-            # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
-            if conn is None:
-                print(("region name: %s likely not supported, or AWS is down.  connection to region failed." % region))
-                sys.exit(1)
-
-            reservations = conn.get_all_instances()
-            for reservation in reservations:
-                instances = sorted(reservation.instances)
-                for instance in instances:
-                    self.add_instance(instance, region)
+                max_results = EC2_PAGE_SIZE
+
+            instances = []
+            next_token = None
+            while True:
+                reservations = conn.get_all_reservations(
+                    filters={'instance-state-name': 'running'},
+                    max_results=max_results, next_token=next_token)
+                instances.extend(chain.from_iterable(
+                    reservation.instances for reservation in reservations))
+                next_token = reservations.next_token
+                if not next_token:
+                    return instances
 
         except boto.exception.BotoServerError as e:
+            if is_throttled(e):
+                # Let the retry loop at the bottom back off and try again
+                raise
             if  not self.eucalyptus:
                 print("Looks like AWS is down again:")
             print(e)
             sys.exit(1)
 
     def get_rds_instances_by_region(self, region):
-	''' Makes an AWS API call to the list of RDS instances in a particular
-        region '''
+        ''' Makes an AWS API call to the list of RDS instances in a particular
+        region, and returns them. Runs in a worker thread, so it must not
+        touch the inventory or the index. '''
+
+        # Imported here rather than at the top, as it is slow to import and
+        # only needed when the cache is refreshed
+        from boto import rds
 
         try:
-            conn = rds.connect_to_region(region)
-            if conn:
-                instances = conn.get_all_dbinstances()
-                for instance in instances:
-                    self.add_rds_instance(instance, region)
+            conn = self.get_connection('rds', region, rds.connect_to_region, region)
+            if not conn:
+                return []
+
+            # Fetched a page at a time, like the EC2 instances
+            instances = []
+            marker = None
+            while True:
+                page = conn.get_all_dbinstances(max_records=RDS_PAGE_SIZE, marker=marker)
+                instances.extend(page)
+                marker = page.marker
+                if not marker:
+                    return instances
         except boto.exception.BotoServerError as e:
+            if is_throttled(e):
+                # Let the retry loop at the bottom back off and try again
+                raise
             print("Looks like AWS RDS is down: ")
             print(e)
             sys.exit(1)
 
     def get_instance(self, region, instance_id):
         ''' Gets details about a specific instance '''
+        conn = self.get_ec2_connection(region)
+
+        reservations = conn.get_all_instances([instance_id])
+        for reservation in reservations:
+            for instance in reservation.instances:
+                return instance
+
+
+    def get_connection(self, service, region, connect, *args):
+        ''' Returns the connection to a service in a region, calling
+        connect(*args) to open it the first time. A boto connection must only
+        be used by one thread at a time. '''
+
+        key = (service, region)
+        conn = self.connections.get(key)
+        if conn is None:
+            conn = self.connections[key] = connect(*args)
+        return conn
+
+
+    def get_ec2_connection(self, region):
+        ''' Returns the EC2 connection to a region, see get_connection '''
+
         if self.eucalyptus:
-            conn = boto.connect_euca(self.eucalyptus_host)
-            conn.APIVersion = '2010-08-31'
+            conn = self.get_connection('ec2', region, self.connect_to_eucalyptus)
+        elif region in self.region_infos:
+            conn = self.get_connection('ec2', region, self.region_infos[region].connect)
         else:
-            conn = ec2.connect_to_region(region)
+            conn = self.get_connection('ec2', region, ec2.connect_to_region, region)
 
         # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
         if conn is None:
             print(("region name: %s likely not supported, or AWS is down.  connection to region failed." % region))
             sys.exit(1)
 
-        reservations = conn.get_all_instances([instance_id])
-        for reservation in reservations:
-            for instance in reservation.instances:
-                return instance
+        return conn
+
+
+    def connect_to_eucalyptus(self):
+        ''' Opens a connection to the private eucalyptus cloud '''
+
+        conn = boto.connect_euca(host=self.eucalyptus_host)
+        conn.APIVersion = '2010-08-31'
+        return conn
 
 
     def add_instance(self, instance, region):
         ''' Adds an instance to the inventory and index, as long as it is
-        addressable '''
-
-        # Only want running instances
-        if instance.state != 'running':
-            return
+        addressable. Only running instances are passed in, see
+        get_instances_by_region '''
 
         # Select the best destination address
         if instance.subnet_id:
@@ -374,16 +509,16 @@ class Ec2Inventory(object):
         self.push(self.inventory, instance.placement, dest)
 
         # Inventory: Group by instance type
-        self.push(self.inventory, self.to_safe('type_' + instance.instance_type), dest)
+        self.push(self.inventory, self.get_group_name(TYPE_PREFIX, instance.instance_type), dest)
 
         # Inventory: Group by key pair
         if instance.key_name:
-            self.push(self.inventory, self.to_safe('key_' + instance.key_name), dest)
+            self.push(self.inventory, self.get_group_name(KEY_PREFIX, instance.key_name), dest)
 
         # Inventory: Group by security group
         try:
             for group in instance.groups:
-                key = self.to_safe("security_group_" + group.name)
+                key = self.get_group_name(SECURITY_GROUP_PREFIX, group.name)
                 self.push(self.inventory, key, dest)
         except AttributeError:
             print('Package boto seems a bit older.')
@@ -392,9 +527,7 @@ class Ec2Inventory(object):
 
         # Inventory: Group by tag keys
         for k, v in six.iteritems(instance.tags):
-            key = self.to_safe("tag_" + k + "=" + v)
-            self.push(self.inventory, key, dest)
-            self.keep_first(self.inventory, 'first_in_' + key, dest)
+            self.add_tag_groups(k, v, dest)
 
         # Inventory: Group by Route53 domain names if enabled
         if self.route53_enabled:
@@ -435,12 +568,12 @@ class Ec2Inventory(object):
         self.push(self.inventory, instance.availability_zone, dest)
 
         # Inventory: Group by instance type
-        self.push(self.inventory, self.to_safe('type_' + instance.instance_class), dest)
+        self.push(self.inventory, self.get_group_name(TYPE_PREFIX, instance.instance_class), dest)
 
         # Inventory: Group by security group
         try:
             if instance.security_group:
-                key = self.to_safe("security_group_" + instance.security_group.name)
+                key = self.get_group_name(SECURITY_GROUP_PREFIX, instance.security_group.name)
                 self.push(self.inventory, key, dest)
         except AttributeError:
             print('Package boto seems a bit older.')
@@ -448,36 +581,67 @@ class Ec2Inventory(object):
             sys.exit(1)
 
         # Inventory: Group by engine
-        self.push(self.inventory, self.to_safe("rds_" + instance.engine), dest)
+        self.push(self.inventory, self.get_group_name(RDS_PREFIX, instance.engine), dest)
 
         # Inventory: Group by parameter group
-        self.push(self.inventory, self.to_safe("rds_parameter_group_" + instance.parameter_group.name), dest)
+        self.push(self.inventory, self.get_group_name(RDS_PARAMETER_GROUP_PREFIX, instance.parameter_group.name), dest)
 
 
     def get_route53_records(self):
         ''' Get and store the map of resource records to domain names that
         point to them. '''
 
-        r53_conn = route53.Route53Connection()
-        all_zones = r53_conn.get_zones()
+        all_zones = self.get_route53_connection().get_zones()
 
         route53_zones = [ zone for zone in all_zones if zone.name[:-1]
                           not in self.route53_excluded_zones ]
+        zone_ids = [zone.id for zone in route53_zones]
+
+        route53_records = defaultdict(set)
+
+        # Fetch the record sets of all zones concurrently, and merge them
+        # from this thread
+        max_workers = max(1, min(MAX_WORKERS, len(zone_ids)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for rrsets in executor.map(self.get_route53_rrsets, zone_ids):
+                for record_set in rrsets:
+                    record_name = record_set.name
+
+                    if record_name.endswith('.'):
+                        record_name = record_name[:-1]
+
+                    for resource in record_set.resource_records:
+                        route53_records[resource].add(record_name)
+
+        # The records are only read from now on, so store the names as
+        # tuples, and keep the set of resources around so that
+        # get_instance_route53_names can intersect with it
+        self.route53_records = dict(
+            (resource, tuple(names)) for resource, names in six.iteritems(route53_records))
+        self.route53_resources = frozenset(self.route53_records)
 
-        self.route53_records = {}
 
-        for zone in route53_zones:
-            rrsets = r53_conn.get_all_rrsets(zone.id)
+    def get_route53_rrsets(self, zone_id):
+        ''' Makes the Route53 API calls to list all the resource record sets
+        of a zone, and returns them. Runs in a worker thread. '''
 
-            for record_set in rrsets:
-                record_name = record_set.name
+        # boto fetches the remaining pages while the record sets are iterated
+        # over, so do that here rather than in the calling thread
+        return list(self.get_route53_connection().get_all_rrsets(zone_id))
 
-                if record_name.endswith('.'):
-                    record_name = record_name[:-1]
 
-                for resource in record_set.resource_records:
-                    self.route53_records.setdefault(resource, set())
-                    self.route53_records[resource].add(record_name)
+    def get_route53_connection(self):
+        ''' Returns the current thread's Route53 connection, see
+        get_connection '''
+
+        # Imported here rather than at the top, as it is slow to import and
+        # only needed when route53 is enabled
+        from boto import route53
+
+        # Route53 has no regions, and the zones are fetched in parallel, so
+        # key the connection by thread instead
+        return self.get_connection('route53', threading.current_thread().ident,
+                                   route53.Route53Connection)
 
 
     def get_instance_route53_names(self, instance):
@@ -485,19 +649,13 @@ class Ec2Inventory(object):
         Route53. If it is, return the list of domain names pointing to said
         instance. If nothing points to it, return an empty list. '''
 
-        instance_attributes = [ 'public_dns_name', 'private_dns_name',
-                                'ip_address', 'private_ip_address' ]
+        addresses = set(getattr(instance, attrib, None)
+                        for attrib in ROUTE53_INSTANCE_ATTRIBUTES)
 
         name_list = set()
 
-        for attrib in instance_attributes:
-            try:
-                value = getattr(instance, attrib)
-            except AttributeError:
-                continue
-
-            if value in self.route53_records:
-                name_list.update(self.route53_records[value])
+        for address in self.route53_resources & addresses:
+            name_list.update(self.route53_records[address])
 
         return list(name_list)
 
@@ -505,18 +663,16 @@ class Ec2Inventory(object):
     def get_host_info(self):
         ''' Get variables about a specific host '''
 
-        if len(self.index) == 0:
-            # Need to load index from cache
-            self.load_index_from_cache()
-
-        if not self.args.host in self.index:
+        index_entry = self.get_index_entry(self.args.host)
+        if index_entry is None:
             # try updating the cache
             self.do_api_calls_update_cache()
-            if not self.args.host in self.index:
+            index_entry = self.get_index_entry(self.args.host)
+            if index_entry is None:
                 # host migh not exist anymore
                 return self.json_format_dict({}, True)
 
-        (region, instance_id) = self.index[self.args.host]
+        (region, instance_id) = index_entry
 
         instance = self.get_instance(region, instance_id)
         instance_vars = {}
@@ -525,12 +681,12 @@ class Ec2Inventory(object):
             key = self.to_safe('ec2_' + key)
 
             # Handle complex types
-            if type(value) in [int, bool]:
+            if value is None:
+                instance_vars[key] = ''
+            elif isinstance(value, (int, bool)):
                 instance_vars[key] = value
-            elif type(value) in [str, six.text_type]:
+            elif isinstance(value, six.string_types):
                 instance_vars[key] = value.strip()
-            elif type(value) == type(None):
-                instance_vars[key] = ''
             elif key == 'ec2_region':
                 instance_vars[key] = value.name
             elif key == 'ec2_tags':
@@ -557,34 +713,58 @@ class Ec2Inventory(object):
 
     def push(self, my_dict, key, element):
         ''' Pushed an element onto an array that may not have been defined in
-        the dict '''
+        the dict. my_dict must be a defaultdict(list) '''
 
-        if key in my_dict:
-            my_dict[key].append(element);
-        else:
-            my_dict[key] = [element]
+        my_dict[key].append(element)
+
+    def add_tag_groups(self, key, value, dest):
+        ''' Adds dest to the group of a tag, and to its first_in_ group if
+        that does not have a host yet '''
+
+        group_name, first_in_group_name = self.get_tag_group_names(key, value)
+        self.inventory[group_name].append(dest)
+        self.inventory.setdefault(first_in_group_name, [dest])
 
-    def keep_first(self, my_dict, key, element):
-        if key not in my_dict:
-            my_dict[key] = [element]
+    def get_tag_groups(self):
+        ''' Returns the names of the inventory groups made from tags, this is
+        what --tags-only lists '''
 
-    def get_inventory_from_cache(self):
-        ''' Reads the inventory from the cache file and returns it as a JSON
-        object '''
+        tag_prefixes = (TAG_PREFIX, FIRST_IN_PREFIX + TAG_PREFIX)
+        return [key for key in self.inventory if key.startswith(tag_prefixes)]
+
+
+    def copy_inventory_from_cache(self, out):
+        ''' Copies the JSON inventory from the cache file to out, without
+        decoding it or reading it all into memory '''
         if self.args.tags_only:
-            cache = open(self.cache_path_tags, 'r')
+            cache_path = self.cache_path_tags
         else:
-            cache = open(self.cache_path_cache, 'r')
-        json_inventory = cache.read()
-        return json_inventory
+            cache_path = self.cache_path_cache
+        with open(cache_path, 'rb', buffering=CACHE_BUFFER_SIZE) as cache:
+            shutil.copyfileobj(cache, out, CACHE_BUFFER_SIZE)
+
 
+    def get_index_entry(self, host):
+        ''' Returns the (region, instance ID) pair of a host, or None if it is
+        not in the index. Uses the index built by this run if there is one,
+        otherwise looks the host up in the index cache file. '''
 
-    def load_index_from_cache(self):
-        ''' Reads the index from the cache file sets self.index '''
+        if self.index:
+            return self.index.get(host)
 
-        cache = open(self.cache_path_index, 'r')
-        json_index = cache.read()
-        self.index = json.loads(json_index)
+        if not os.path.isfile(self.cache_path_index):
+            return None
+
+        db = sqlite3.connect(self.cache_path_index)
+        try:
+            return db.execute('SELECT region, instance_id FROM idx WHERE host = ?',
+                              (host,)).fetchone()
+        except sqlite3.DatabaseError:
+            # Not an index written by this version, treat it as a miss so
+            # that the cache gets refreshed
+            return None
+        finally:
+            db.close()
 
 
     def write_to_cache(self, data, filename):
@@ -592,36 +772,128 @@ class Ec2Inventory(object):
             Writes data in JSON format to a file
             '''
 
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        self.replace_file(filename, self.write_json_file, data)
+
+
+    def write_json_file(self, path, data):
+        ''' Writes data in JSON format to path '''
+
+        with open(path, 'wb', buffering=CACHE_BUFFER_SIZE) as cache:
+            for chunk in self.iter_json_chunks(data, True):
+                cache.write(chunk)
+
+
+    def write_index_to_cache(self):
+        ''' Writes the index to an SQLite database, so that --host can look up
+        a single host without loading the whole index '''
+
+        self.replace_file(self.cache_path_index, self.write_index_file)
+
+
+    def write_index_file(self, path):
+        ''' Writes the index to a new SQLite database at path '''
+
+        db = sqlite3.connect(path)
+        try:
+            db.execute('CREATE TABLE idx (host TEXT PRIMARY KEY, region TEXT, instance_id TEXT)')
+            db.executemany('INSERT INTO idx VALUES (?, ?, ?)',
+                           ((host, region, instance_id)
+                            for host, (region, instance_id) in six.iteritems(self.index)))
+            db.commit()
+        finally:
+            db.close()
+
+
+    def replace_file(self, filename, write, *args):
+        ''' Calls write(tmp_path, *args) and moves the result over filename,
+        so that concurrent runs never read or write a partial cache file '''
+
+        tmp_path = '{}.{}.tmp'.format(filename, os.getpid())
+        if os.path.exists(tmp_path):
+            # Left behind by a crashed process that had the same pid
+            os.remove(tmp_path)
+
+        try:
+            write(tmp_path, *args)
+            os.rename(tmp_path, filename)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+    def get_group_name(self, prefix, name):
+        ''' Returns the Ansible group name made of a prefix and a name. The
+        same few names come up for many instances, so the result is cached
+        and every instance in a group shares the one string. '''
+
+        key = (prefix, name)
+        group_name = self.group_names.get(key)
+        if group_name is None:
+            group_name = self.group_names[key] = self.to_safe(prefix + name)
+        return group_name
+
+
+    def get_tag_group_names(self, key, value):
+        ''' Returns the names of the group of a tag and of its first_in_
+        group. Cached like get_group_name. '''
+
+        tag = (key, value)
+        group_names = self.tag_group_names.get(tag)
+        if group_names is None:
+            group_name = self.to_safe(TAG_PREFIX + key + "=" + value)
+            group_names = self.tag_group_names[tag] = (
+                group_name, FIRST_IN_PREFIX + group_name)
+        return group_names
 
 
     def to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be
         used as Ansible groups '''
 
-        return re.sub("[^A-Za-z0-9\-]", "_", word)
+        return UNSAFE_CHARS_RE.sub("_", word)
 
 
-    def json_format_dict(self, data, pretty=False):
-        ''' Converts a dict to a JSON object and dumps it as a formatted
-        string '''
-        if self.args.tags_only:
-            data = [key for key in data.keys() if 'tag_' in key]
+    def iter_json_chunks(self, data, pretty=False):
+        ''' Converts a dict to a JSON object and yields it as chunks of
+        formatted UTF-8 encoded bytes. Uses orjson when it is installed, as it
+        is much faster than json on large inventories, otherwise the JSON is
+        encoded incrementally so it never has to be held in memory at once '''
+        if orjson is not None:
+            option = orjson.OPT_SORT_KEYS
+            if pretty:
+                option |= orjson.OPT_INDENT_2
+            yield orjson.dumps(data, option=option)
+            return
         if pretty:
-            return json.dumps(data, sort_keys=True, indent=2)
+            encoder = json.JSONEncoder(sort_keys=True, indent=2)
         else:
-            return json.dumps(data)
+            encoder = json.JSONEncoder()
+        for chunk in encoder.iterencode(data):
+            yield chunk.encode('utf-8')
+
+
+    def json_format_dict(self, data, pretty=False):
+        ''' Converts a dict to a JSON object and dumps it as formatted UTF-8
+        encoded bytes '''
+        return b''.join(self.iter_json_chunks(data, pretty))
 
 
 # Run the script
 RETRIES = 3
 
-for _ in range(RETRIES):
+for attempt in range(RETRIES):
     try:
         Ec2Inventory()
         break
+    except boto.exception.BotoServerError as e:
+        # Give up with a non-zero exit status unless AWS is throttling us
+        # and there are attempts left
+        if not is_throttled(e) or attempt + 1 == RETRIES:
+            raise
+        traceback.print_exc()
+        # Back off exponentially, with some jitter so that ansible
+        # processes running in parallel do not all retry at once
+        sleep(2 ** attempt + random.random())
     except Exception:
         traceback.print_exc()